@@ -14,11 +14,18 @@ Usage (local dev):
 2. Create and activate venv, install requirements (see requirements list below)
 3. Initialize DB: python tounfite_souk.py initdb
 4. Run: python tounfite_souk.py
+   (set TEMPLATES_AUTO_RELOAD=1 while editing files in templates/)
 
 Notes on Email Verification:
 - Configure SMTP via environment variables: MAIL_SERVER, MAIL_PORT, MAIL_USERNAME, MAIL_PASSWORD, MAIL_USE_TLS
 - If SMTP not configured, verification email content will be printed to console (safe for testing)
 
+Notes on serving uploads:
+- Uploaded image names are random and never reused, so /uploads/ responses are cacheable for a day
+- Behind nginx, serve them without going through Flask:
+    location ~ ^/uploads/[.] { deny all; }
+    location /uploads/ { alias /path/to/static/uploads/; sendfile on; tcp_nopush on; expires 1d; }
+
 Requirements (add to requirements.txt):
 flask
 flask-login
@@ -27,18 +34,27 @@ werkzeug
 itsdangerous
 flask-mail
 python-dotenv
+flask-caching
 
 """
-from flask import Flask, render_template, redirect, url_for, request, flash, abort, session, send_from_directory
+from flask import Flask, Request, render_template, redirect, url_for, request, flash, abort, session, send_from_directory
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import case, column, event, func, insert, or_, text
+from sqlalchemy.orm import raiseload
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
-from itsdangerous import URLSafeTimedSerializer
-from flask_mail import Mail, Message
+from itsdangerous import TimestampSigner, URLSafeTimedSerializer
+from itsdangerous.encoding import want_bytes
+from flask_mail import Mail, Message as MailMessage
+from flask_caching import Cache
+from markupsafe import Markup
+from jinja2 import ChoiceLoader, DictLoader, FileSystemBytecodeCache, FileSystemLoader
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import os
+import secrets
 import sys
+import tempfile
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -48,18 +64,42 @@ load_dotenv()
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 DB_PATH = os.path.join(BASE_DIR, 'market.db')
 TEMPLATES_DIR = os.path.join(BASE_DIR, 'templates')
+JINJA_CACHE_DIR = os.path.join(BASE_DIR, '.jinja_cache')
 UPLOAD_FOLDER = os.path.join(BASE_DIR, 'static', 'uploads')
+# not served, but on the same filesystem as UPLOAD_FOLDER so keeping an upload is a rename
+UPLOAD_SPOOL_DIR = os.path.join(BASE_DIR, '.upload_spool')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+ITEMS_PER_PAGE = 24
 
 # Ensure upload folder exists
 Path(UPLOAD_FOLDER).mkdir(parents=True, exist_ok=True)
-Path(TEMPLATES_DIR).mkdir(parents=True, exist_ok=True)
+Path(UPLOAD_SPOOL_DIR).mkdir(parents=True, exist_ok=True)
+Path(JINJA_CACHE_DIR).mkdir(parents=True, exist_ok=True)
+
+class UploadRequest(Request):
+    # Spool uploaded files to disk next to the upload folder (instead of memory or /tmp)
+    # so saving an image is a rename rather than a second copy of the bytes.
+    # Every spooled file is tracked so the teardown can remove it even when parsing fails part-way.
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        spooled = tempfile.NamedTemporaryFile('wb+', dir=UPLOAD_SPOOL_DIR, prefix='.upload-', delete=False)
+        self.__dict__.setdefault('_spooled', []).append(spooled)
+        return spooled
 
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'change_this_secret_in_prod')
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + DB_PATH
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['CACHE_TYPE'] = os.getenv('CACHE_TYPE', 'SimpleCache')
+app.config['CACHE_DEFAULT_TIMEOUT'] = 60
+# Testing/dev aid: make relationship lazy loads that would emit SQL raise instead (catches N+1 regressions)
+app.config['RAISE_ON_LAZY_SQL'] = os.getenv('RAISE_ON_LAZY_SQL','False').lower() in ('1','true','yes')
+# Templates are not re-stat'ed per render unless asked for; compiled templates are
+# kept on disk so each worker loads bytecode instead of re-parsing the source
+app.config['TEMPLATES_AUTO_RELOAD'] = os.getenv('TEMPLATES_AUTO_RELOAD','False').lower() in ('1','true','yes')
+app.jinja_env.auto_reload = app.config['TEMPLATES_AUTO_RELOAD']
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
 
 # Mail config (optional)
 app.config['MAIL_SERVER'] = os.getenv('MAIL_SERVER')
@@ -72,11 +112,41 @@ app.config['MAIL_DEFAULT_SENDER'] = os.getenv('MAIL_DEFAULT_SENDER', app.config[
 # Initialize
 db = SQLAlchemy(app)
 mail = Mail(app)
+email_executor = ThreadPoolExecutor(max_workers=2)
+cache = Cache(app)
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
+def set_sqlite_pragmas(dbapi_conn, connection_record):
+    # WAL + synchronous=NORMAL: a commit is one append to the log instead of two fsyncs,
+    # and readers of the listing don't block on a concurrent add_item
+    cur = dbapi_conn.cursor()
+    cur.execute('PRAGMA journal_mode=WAL')
+    cur.execute('PRAGMA synchronous=NORMAL')
+    cur.execute('PRAGMA mmap_size=268435456')  # 256 MiB memory-mapped reads
+    cur.execute('PRAGMA cache_size=-65536')  # 64 MiB page cache
+    cur.execute('PRAGMA temp_store=MEMORY')
+    cur.close()
+
+# only the app's own SQLite engine, not every engine in the process
+with app.app_context():
+    event.listen(db.engine, 'connect', set_sqlite_pragmas)
+
 # Serializer for tokens
-s = URLSafeTimedSerializer(app.config['SECRET_KEY'])
+class CachedKeySigner(TimestampSigner):
+    # itsdangerous builds a new signer and re-derives the HMAC key on every dumps/loads;
+    # the key only depends on (derivation, digest, salt, secret), so derive it once per process.
+    _derived_keys = {}
+
+    def derive_key(self, secret_key=None):
+        secret_key = self.secret_keys[-1] if secret_key is None else want_bytes(secret_key)
+        cache_key = (self.key_derivation, self.digest_method, self.salt, secret_key)
+        key = self._derived_keys.get(cache_key)
+        if key is None:
+            key = self._derived_keys[cache_key] = super().derive_key(secret_key)
+        return key
+
+s = URLSafeTimedSerializer(app.config['SECRET_KEY'], signer=CachedKeySigner)
 
 # Simple i18n dictionaries
 I18N = {
@@ -105,11 +175,13 @@ I18N = {
         'contact': 'اتصال بالبائع',
     }
 }
+# bound dict.get per language, so a template lookup is a single call
+I18N_LOOKUPS = {lang: strings.get for lang, strings in I18N.items()}
 
 # --- Models ---
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    email = db.Column(db.String(150), unique=True, nullable=False)
+    email = db.Column(db.String(150), unique=True, index=True, nullable=False)
     password_hash = db.Column(db.String(200), nullable=False)
     role = db.Column(db.String(20), nullable=False, default='buyer')  # 'seller' or 'buyer'
     name = db.Column(db.String(120))
@@ -119,7 +191,8 @@ class User(UserMixin, db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        # scrypt runs in OpenSSL and releases the GIL, so logins on other threads are not blocked
+        self.password_hash = generate_password_hash(password, method='scrypt')
 
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
@@ -131,8 +204,8 @@ class Item(db.Model):
     description = db.Column(db.Text)
     city = db.Column(db.String(120))
     image_filename = db.Column(db.String(300))
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    seller_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    seller_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     seller = db.relationship('User', backref=db.backref('items', lazy=True))
 
 class Message(db.Model):
@@ -144,43 +217,119 @@ class Message(db.Model):
     sender = db.relationship('User', foreign_keys=[sender_id])
     receiver = db.relationship('User', foreign_keys=[receiver_id])
 
+    __table_args__ = (
+        # each branch of the conversation lookup in messages() is an index range; the two
+        # branches are still merged and sorted afterwards, but only that conversation's rows
+        db.Index('ix_msg_sender_receiver_created', 'sender_id', 'receiver_id', 'created_at'),
+        # receiver-leading, so "sender = me OR receiver = me" can use an index for both branches
+        db.Index('ix_msg_receiver_sender', 'receiver_id', 'sender_id'),
+    )
+
+@event.listens_for(db.session, 'do_orm_execute')
+def raise_on_lazy_sql(orm_execute_state):
+    # sql_only: lazy loads that resolve from the identity map are still allowed
+    if app.config['RAISE_ON_LAZY_SQL'] and orm_execute_state.is_select and not orm_execute_state.is_relationship_load:
+        orm_execute_state.statement = orm_execute_state.statement.options(raiseload('*', sql_only=True))
+
+# --- Full-text search (SQLite FTS5 index over item title/description, kept in sync by triggers) ---
+SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS item_fts USING fts5(title, description, content='item', content_rowid='id')",
+    """CREATE TRIGGER IF NOT EXISTS item_fts_ai AFTER INSERT ON item BEGIN
+         INSERT INTO item_fts(rowid, title, description) VALUES (new.id, new.title, new.description);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS item_fts_ad AFTER DELETE ON item BEGIN
+         INSERT INTO item_fts(item_fts, rowid, title, description) VALUES ('delete', old.id, old.title, old.description);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS item_fts_au AFTER UPDATE ON item BEGIN
+         INSERT INTO item_fts(item_fts, rowid, title, description) VALUES ('delete', old.id, old.title, old.description);
+         INSERT INTO item_fts(rowid, title, description) VALUES (new.id, new.title, new.description);
+       END""",
+]
+SEARCH_OBJECTS = {'item_fts', 'item_fts_ai', 'item_fts_ad', 'item_fts_au'}
+
+def init_search_index():
+    # safe to run on every initdb: the triggers are dropped along with `item` while
+    # item_fts survives, so each object is (re)created independently
+    present = set(db.session.execute(text("SELECT name FROM sqlite_master")).scalars()) & SEARCH_OBJECTS
+    for stmt in SEARCH_DDL:
+        db.session.execute(text(stmt))
+    if present != SEARCH_OBJECTS:
+        # re-index rows written while the table or a trigger was missing
+        db.session.execute(text("INSERT INTO item_fts(item_fts) VALUES ('rebuild')"))
+    db.session.commit()
+
+def search_item_ids(q):
+    # every word must match as a prefix; quoting keeps user input out of the FTS query syntax
+    match = ' '.join('"%s"*' % word.replace('"', '""') for word in q.split())
+    return text("SELECT rowid FROM item_fts WHERE item_fts MATCH :match").bindparams(match=match).columns(column('rowid'))
+
 # --- Login loader ---
+@cache.memoize(60)
+def _get_user(user_id):
+    return db.session.get(User, user_id)
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # The cached copy is detached and, with a per-process cache, may lag a write made in
+    # another worker; treat it as read-only and load a fresh row in views that write.
+    return _get_user(int(user_id))
 
 # --- Helpers ---
+def send_message(sender_id, receiver_id, content):
+    # INSERT ... RETURNING hands back the new id without reloading the row
+    message_id = db.session.execute(
+        insert(Message).returning(Message.id),
+        dict(sender_id=sender_id, receiver_id=receiver_id, content=content),
+    ).scalar_one()
+    db.session.commit()
+    return message_id
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def save_upload(upload, filename):
+    # move the spooled upload into place (see UploadRequest)
+    upload.stream.close()
+    dest = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    os.replace(upload.stream.name, dest)
+    os.chmod(dest, 0o644)
+
+@app.teardown_request
+def cleanup_uploads(exc):
+    # remove spooled uploads that were not kept by the view, including ones from aborted/malformed bodies
+    for spooled in request.__dict__.get('_spooled', ()):
+        spooled.close()
+        try:
+            os.remove(spooled.name)
+        except FileNotFoundError:
+            pass
+
 def send_verification_email(user):
     token = s.dumps(user.email, salt='email-verify')
     verify_url = url_for('verify_email', token=token, _external=True)
-    subject = 'Verify your Tounfite Souk account'
-    body = f'Hi {user.name or user.email},
+    # SMTP runs off the request thread; pass plain values, not the session-bound User
+    email_executor.submit(_send_verification_email_sync, user.email, user.name, token, verify_url)
 
-Click to verify your account: {verify_url}
-
-Or use code: {token}
-
-If you did not register, ignore.'
+def _send_verification_email_sync(email, name, token, verify_url):
+    subject = 'Verify your Tounfite Souk account'
+    body = f'Hi {name or email},\n\nClick to verify your account: {verify_url}\n\nOr use code: {token}\n\nIf you did not register, ignore.'
     if app.config.get('MAIL_SERVER'):
         try:
-            msg = Message(subject=subject, recipients=[user.email], body=body)
-            mail.send(msg)
-            print('Verification email sent to', user.email)
+            with app.app_context():
+                msg = MailMessage(subject=subject, recipients=[email], body=body)
+                mail.send(msg)
+            print('Verification email sent to', email)
         except Exception as e:
             print('Failed to send email via SMTP, printing content instead. Error:', e)
-            print('EMAIL BODY:
-', body)
+            print('EMAIL BODY:\n', body)
     else:
         # Mail not configured -> print token so developer can test
         print('--- Verification Email (DEV) ---')
-        print('To:', user.email)
+        print('To:', email)
         print(body)
         print('--- End Email ---')
 
-# --- Templates writing (create if missing) ---
+# --- Built-in templates (used unless overridden by a file in templates/) ---
 BASE_HTML = '''<!doctype html>
 <html lang="{{ lang }}" dir="{{ 'rtl' if lang=='ar' else 'ltr' }}">
 <head>
@@ -196,14 +345,29 @@ BASE_HTML = '''<!doctype html>
   </style>
 </head>
 <body class="{{ 'dark' if theme=='dark' else '' }}">
-<nav class="navbar navbar-expand-lg navbar-light bg-light mb-3 {{ 'dark' if theme=='dark' else '' }}">
+{{ navbar }}
+<div class="container">
+  {% with messages = get_flashed_messages() %}
+    {% if messages %}
+      <div class="alert alert-info">{{ messages[0] }}</div>
+    {% endif %}
+  {% endwith %}
+  {% block content %}{% endblock %}
+</div>
+<script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js"></script>
+</body>
+</html>
+'''
+
+# Navbar is rendered once per (lang, theme, auth state, role) and cached, see _render_navbar
+NAVBAR_HTML = '''<nav class="navbar navbar-expand-lg navbar-light bg-light mb-3 {{ 'dark' if theme=='dark' else '' }}">
   <div class="container">
     <a class="navbar-brand" href="{{ url_for('index') }}">{{ _('app_name') }}</a>
     <div class="collapse navbar-collapse">
       <ul class="navbar-nav ms-auto">
         <li class="nav-item"><a class="nav-link" href="{{ url_for('items') }}">{{ _('items') }}</a></li>
-        {% if current_user.is_authenticated %}
-          {% if current_user.role == 'seller' %}
+        {% if authenticated %}
+          {% if role == 'seller' %}
             <li class="nav-item"><a class="nav-link" href="{{ url_for('add_item') }}">{{ _('add_item') }}</a></li>
             <li class="nav-item"><a class="nav-link" href="{{ url_for('my_items') }}">My Items</a></li>
           {% endif %}
@@ -218,25 +382,14 @@ BASE_HTML = '''<!doctype html>
         <li class="nav-item dropdown">
           <a class="nav-link dropdown-toggle" href="#" role="button" data-bs-toggle="dropdown">{{ lang.upper() }}</a>
           <ul class="dropdown-menu dropdown-menu-end">
-            <li><a class="dropdown-item" href="{{ url_for('set_lang','en') }}">EN</a></li>
-            <li><a class="dropdown-item" href="{{ url_for('set_lang','ar') }}">AR</a></li>
+            <li><a class="dropdown-item" href="{{ url_for('set_lang', lang='en') }}">EN</a></li>
+            <li><a class="dropdown-item" href="{{ url_for('set_lang', lang='ar') }}">AR</a></li>
           </ul>
         </li>
       </ul>
     </div>
   </div>
 </nav>
-<div class="container">
-  {% with messages = get_flashed_messages() %}
-    {% if messages %}
-      <div class="alert alert-info">{{ messages[0] }}</div>
-    {% endif %}
-  {% endwith %}
-  {% block content %}{% endblock %}
-</div>
-<script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js"></script>
-</body>
-</html>
 '''
 
 INDEX_HTML = '''{% extends 'base.html' %}
@@ -376,16 +529,22 @@ ITEMS_HTML = '''{% extends 'base.html' %}
       {% endif %}
       <div class="card-body d-flex flex-column">
         <h5 class="card-title">{{ item.title }}</h5>
-        <p class="card-text">{{ item.description[:120] }}</p>
+        <p class="card-text">{{ item.desc120 or '' }}</p>
         <p class="mt-auto"><strong>{{ item.price }} MAD</strong></p>
-        <p>Seller: {{ item.seller.name or item.seller.email }}</p>
+        <p>Seller: {{ item.seller_name or item.seller_email }}</p>
         <p>City: {{ item.city }}</p>
-        <p><a class="btn btn-sm btn-outline-primary" href="{{ url_for('contact_seller', seller_id=item.seller.id) }}">{{ _('contact') }}</a></p>
+        <p><a class="btn btn-sm btn-outline-primary" href="{{ url_for('contact_seller', seller_id=item.seller_id) }}">{{ _('contact') }}</a></p>
       </div>
     </div>
   </div>
   {% endfor %}
 </div>
+{% if page is defined and (page > 1 or has_next) %}
+<nav class="d-flex justify-content-between mb-3">
+  {% if page > 1 %}<a class="btn btn-outline-secondary" href="{{ url_for('items', q=request.args.get('q',''), city=request.args.get('city',''), page=page-1) }}">&laquo; Previous</a>{% else %}<span></span>{% endif %}
+  {% if has_next %}<a class="btn btn-outline-secondary" href="{{ url_for('items', q=request.args.get('q',''), city=request.args.get('city',''), page=page+1) }}">Next &raquo;</a>{% endif %}
+</nav>
+{% endif %}
 {% endblock %}
 '''
 
@@ -402,17 +561,39 @@ MESSAGES_HTML = '''{% extends 'base.html' %}
     </ul>
   </div>
   <div class="col-md-8">
-    {% if messages_list is defined %}
+    {% if other %}
       <h5>Conversation with {{ other.name or other.email }}</h5>
-      <div class="mb-3">
+      <div class="mb-3" id="message-list">
         {% for m in messages_list %}
-          <div class="p-2 mb-2" style="background:#f1f1f1;border-radius:6px">{{ m.sender.name or m.sender.email }}: {{ m.content }}</div>
+          {% with message_id=m.id, sender=(current_user if m.sender_id == current_user.id else other), content=m.content %}{% include 'message.html' %}{% endwith %}
         {% endfor %}
       </div>
-      <form method="post">
+      <form method="post" id="message-form">
         <div class="mb-3"><textarea class="form-control" name="content" required></textarea></div>
         <button class="btn btn-primary">Send</button>
       </form>
+      <div class="alert alert-danger mt-2 d-none" id="message-error">Message could not be sent.</div>
+      <script>
+        // send without reloading the page: the server answers with just the new message
+        document.getElementById('message-form').addEventListener('submit', async (e) => {
+          e.preventDefault();
+          const form = e.target;
+          const error = document.getElementById('message-error');
+          error.classList.add('d-none');
+          let resp;
+          try {
+            resp = await fetch(form.action, {method: 'POST', body: new FormData(form), headers: {'X-Requested-With': 'fetch'}});
+          } catch (err) {
+            resp = null;
+          }
+          // redirected (e.g. to /login after the session expired): nothing was stored, so a normal post is safe
+          if (resp && resp.redirected) return form.submit();
+          // any other failure may come after the message was saved; report it rather than posting it twice
+          if (!resp || resp.status !== 201) return error.classList.remove('d-none');
+          document.getElementById('message-list').insertAdjacentHTML('beforeend', await resp.text());
+          form.reset();
+        });
+      </script>
     {% else %}
       <p>Select a conversation.</p>
     {% endif %}
@@ -421,6 +602,9 @@ MESSAGES_HTML = '''{% extends 'base.html' %}
 {% endblock %}
 '''
 
+MESSAGE_HTML = '''<div class="p-2 mb-2" style="background:#f1f1f1;border-radius:6px" data-id="{{ message_id }}">{{ sender.name or sender.email }}: {{ content }}</div>
+'''
+
 CONTACT_HTML = '''{% extends 'base.html' %}
 {% block content %}
 <h2>{{ _('contact') }}</h2>
@@ -431,9 +615,9 @@ CONTACT_HTML = '''{% extends 'base.html' %}
 {% endblock %}
 '''
 
-# Write templates if missing
 templates = {
     'base.html': BASE_HTML,
+    'navbar.html': NAVBAR_HTML,
     'index.html': INDEX_HTML,
     'register.html': REGISTER_HTML,
     'login.html': LOGIN_HTML,
@@ -441,13 +625,11 @@ templates = {
     'add_item.html': ADD_ITEM_HTML,
     'items.html': ITEMS_HTML,
     'messages.html': MESSAGES_HTML,
+    'message.html': MESSAGE_HTML,
     'contact.html': CONTACT_HTML,
 }
-for name, content in templates.items():
-    path = os.path.join(TEMPLATES_DIR, name)
-    if not os.path.isfile(path):
-        with open(path, 'w', encoding='utf-8') as f:
-            f.write(content)
+# Files in templates/ take precedence; anything missing there is served from the strings above
+app.jinja_loader = ChoiceLoader([FileSystemLoader(TEMPLATES_DIR), DictLoader(templates)])
 
 # --- i18n helper ---
 def get_lang():
@@ -455,13 +637,25 @@ def get_lang():
     if lang not in I18N: lang = 'en'
     return lang
 
-def _(key):
-    lang = get_lang()
-    return I18N.get(lang, I18N['en']).get(key, key)
+def _gettext(lang):
+    # the `_` callable templates use for one language
+    lookup = I18N_LOOKUPS[lang]
+    return lambda key: lookup(key, key)
+
+@cache.memoize(3600)
+def _render_navbar(lang, theme, authenticated, role):
+    # rendered outside render_template so context processors (and this one) don't run again
+    template = app.jinja_env.get_template('navbar.html')
+    return Markup(template.render(_=_gettext(lang), lang=lang, theme=theme,
+                                  authenticated=authenticated, role=role))
 
 @app.context_processor
 def inject_globals():
-    return dict(_=_, lang=get_lang(), theme=session.get('theme','light'))
+    lang = get_lang()
+    theme = session.get('theme','light')
+    authenticated = current_user.is_authenticated
+    navbar = _render_navbar(lang, theme, authenticated, current_user.role if authenticated else None)
+    return dict(_=_gettext(lang), lang=lang, theme=theme, navbar=navbar)
 
 # --- Routes ---
 @app.route('/')
@@ -517,6 +711,7 @@ def verify_email(token):
         return redirect(url_for('index'))
     user.verified = True
     db.session.commit()
+    cache.delete_memoized(_get_user, user.id)
     flash('Email verified — thank you!')
     return redirect(url_for('index'))
 
@@ -545,10 +740,12 @@ def logout():
 @login_required
 def profile():
     if request.method == 'POST':
-        current_user.name = request.form.get('name')
-        current_user.phone = request.form.get('phone')
-        current_user.city = request.form.get('city')
+        user = db.session.get(User, current_user.id)
+        user.name = request.form.get('name')
+        user.phone = request.form.get('phone')
+        user.city = request.form.get('city')
         db.session.commit()
+        cache.delete_memoized(_get_user, user.id)
         flash('Profile updated')
         return redirect(url_for('profile'))
     return render_template('profile.html')
@@ -566,12 +763,11 @@ def add_item():
         image = request.files.get('image')
         filename = None
         if image and allowed_file(image.filename):
-            fname = secure_filename(image.filename)
-            # make unique
-            timestamp = datetime.utcnow().strftime('%Y%m%d%H%M%S')
-            filename = f"{current_user.id}_{timestamp}_{fname}"
-            image.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-        item = Item(title=title, price=float(price), description=description, city=city, image_filename=filename, seller=current_user)
+            # random name keeps it unique; the extension was already checked by allowed_file
+            ext = image.filename.rsplit('.', 1)[1].lower()
+            filename = f"{current_user.id}_{secrets.token_hex(8)}.{ext}"
+            save_upload(image, filename)
+        item = Item(title=title, price=float(price), description=description, city=city, image_filename=filename, seller_id=current_user.id)
         db.session.add(item)
         db.session.commit()
         flash('Item added')
@@ -580,83 +776,104 @@ def add_item():
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    if filename.startswith('.'):
+        abort(404)
+    return send_from_directory(app.config['UPLOAD_FOLDER'], filename, conditional=True, etag=True, max_age=86400)
+
+def item_cards_query():
+    # only the columns items.html shows: the description is cut to 120 chars in SQL and
+    # the seller is joined in, so a listing is a single narrow query
+    return db.session.query(
+        Item.id, Item.title, Item.price, Item.city, Item.image_filename,
+        func.substr(Item.description, 1, 120).label('desc120'),
+        Item.seller_id, User.name.label('seller_name'), User.email.label('seller_email'),
+    ).join(User, Item.seller_id == User.id).order_by(Item.created_at.desc())
 
 @app.route('/items')
 def items():
     q = request.args.get('q', '').strip()
     city = request.args.get('city', '').strip()
-    items_q = Item.query.order_by(Item.created_at.desc())
+    items_q = item_cards_query()
     if q:
-        items_q = items_q.filter((Item.title.contains(q)) | (Item.description.contains(q)))
+        items_q = items_q.filter(Item.id.in_(search_item_ids(q)))
     if city:
         items_q = items_q.filter(Item.city.contains(city))
-    items_list = items_q.all()
-    return render_template('items.html', items=items_list)
+    page = max(request.args.get('page', 1, type=int), 1)
+    # fetch one extra row to know whether there is a next page, without a COUNT(*)
+    items_list = items_q.limit(ITEMS_PER_PAGE + 1).offset((page - 1) * ITEMS_PER_PAGE).all()
+    has_next = len(items_list) > ITEMS_PER_PAGE
+    return render_template('items.html', items=items_list[:ITEMS_PER_PAGE], page=page, has_next=has_next)
 
 @app.route('/my_items')
 @login_required
 def my_items():
     if current_user.role != 'seller':
         abort(403)
-    items_list = Item.query.filter_by(seller_id=current_user.id).order_by(Item.created_at.desc()).all()
+    items_list = item_cards_query().filter(Item.seller_id == current_user.id).all()
     return render_template('items.html', items=items_list)
 
 @app.route('/contact/<int:seller_id>', methods=['GET','POST'])
 @login_required
 def contact_seller(seller_id):
-    seller = User.query.get_or_404(seller_id)
+    seller = db.get_or_404(User, seller_id)
     if request.method == 'POST':
         content = request.form.get('content')
         if not content:
             flash('Message cannot be empty')
             return redirect(url_for('contact_seller', seller_id=seller_id))
-        m = Message(sender_id=current_user.id, receiver_id=seller.id, content=content)
-        db.session.add(m)
-        db.session.commit()
+        send_message(current_user.id, seller.id, content)
         flash('Message sent')
-        return redirect(url_for('messages'))
+        return redirect(url_for('messages', with_id=seller.id))
     return render_template('contact.html')
 
 @app.route('/messages', methods=['GET','POST'])
 @login_required
 def messages():
+    with_id = request.args.get('with_id', type=int)
+    if request.method == 'POST' and with_id:
+        # handled before the listing queries below, which a redirect would throw away
+        other = db.get_or_404(User, with_id)
+        content = request.form.get('content')
+        if not content:
+            abort(400)
+        message_id = send_message(current_user.id, other.id, content)
+        if request.headers.get('X-Requested-With') == 'fetch':
+            return render_template('message.html', message_id=message_id, sender=current_user, content=content), 201
+        return redirect(url_for('messages', with_id=other.id))
+
     # list conversation partners
-    # partners: users who sent or received messages with current_user
-    partners = set()
-    for m in Message.query.filter((Message.sender_id==current_user.id) | (Message.receiver_id==current_user.id)).all():
-        partners.add(m.sender_id if m.sender_id!=current_user.id else m.receiver_id)
-    conv_users = User.query.filter(User.id.in_(list(partners))).all() if partners else []
+    # partners: users who sent or received messages with current_user (DISTINCT computed in SQL)
+    partner_ids = db.session.query(
+        case((Message.sender_id==current_user.id, Message.receiver_id), else_=Message.sender_id)
+    ).filter(or_(Message.sender_id==current_user.id, Message.receiver_id==current_user.id)).distinct().all()
+    partners = [p for (p,) in partner_ids]
+    conv_users = User.query.filter(User.id.in_(partners)).all() if partners else []
 
     other = None
     messages_list = None
-    with_id = request.args.get('with_id')
     if with_id:
-        other = User.query.get(int(with_id))
+        # conv_users are already in the session's identity map, so this is usually SQL-free;
+        # messages.html picks each sender from current_user/other instead of loading m.sender
+        other = db.session.get(User, with_id)
         if other:
             messages_list = Message.query.filter(
                 ((Message.sender_id==current_user.id)&(Message.receiver_id==other.id))|
                 ((Message.sender_id==other.id)&(Message.receiver_id==current_user.id))
             ).order_by(Message.created_at).all()
-    if request.method == 'POST' and other:
-        content = request.form.get('content')
-        if content:
-            m = Message(sender_id=current_user.id, receiver_id=other.id, content=content)
-            db.session.add(m)
-            db.session.commit()
-            return redirect(url_for('messages', with_id=other.id))
     return render_template('messages.html', conv_users=conv_users, messages_list=messages_list, other=other)
 
 # --- CLI to init DB ---
 @app.cli.command('initdb')
 def initdb_command():
     db.create_all()
+    init_search_index()
     print('Initialized the database.')
 
 if __name__ == '__main__':
     if len(sys.argv) > 1 and sys.argv[1] == 'initdb':
         with app.app_context():
             db.create_all()
+            init_search_index()
             print('Database created at', DB_PATH)
     else:
         app.run(debug=True)